@@ -1,22 +1,59 @@
 import os
+import re
 import io
-import json
-import pandas as pd
-from fastapi import FastAPI, UploadFile, File, HTTPException
-from fastapi.responses import StreamingResponse
+import orjson
+import csv
+import asyncio
+import itertools
+import time
+import hashlib
+import tempfile
+import contextlib
+from typing import Annotated, Dict, List, Optional
+from datetime import datetime, timezone
+from functools import lru_cache
+from fastapi import FastAPI, UploadFile, File, HTTPException, Request, Depends
+from fastapi.responses import StreamingResponse, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
+from brotli_asgi import BrotliMiddleware
+from pydantic import BaseModel, BeforeValidator, ConfigDict, Field, TypeAdapter, ValidationError
 import google.generativeai as genai
 from pdf2image import convert_from_bytes
 from PIL import Image
+import xlsxwriter
 
 # --- Configuration & Startup Check ---
 try:
     GEMINI_API_KEY = os.environ["GEMINI_API_KEY"]
-    genai.configure(api_key=GEMINI_API_KEY)
+    # Pin the gRPC transport so concurrent calls from worker threads multiplex over one channel.
+    genai.configure(api_key=GEMINI_API_KEY, transport="grpc")
 except KeyError:
     raise RuntimeError("FATAL: GEMINI_API_KEY environment variable not set.")
 
-app = FastAPI()
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    # Expired cache entries are otherwise only removed when the same upload comes back.
+    sweeper = asyncio.create_task(sweep_cache_periodically())
+    try:
+        yield
+    finally:
+        sweeper.cancel()
+
+app = FastAPI(lifespan=lifespan)
+
+# Uploads are capped so a single oversized PDF can't exhaust worker memory during rasterization.
+MAX_UPLOAD_BYTES = 30 * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+UPLOAD_SPOOL_SIZE = 8 * 1024 * 1024
+
+@app.middleware("http")
+async def limit_upload_size(request: Request, call_next):
+    # Reject early on the declared size, before the multipart body is parsed; a small
+    # allowance covers the multipart boundaries and part headers.
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > MAX_UPLOAD_BYTES + 64 * 1024:
+        return JSONResponse(status_code=413, content={"detail": "File too large."})
+    return await call_next(request)
 
 app.add_middleware(
     CORSMiddleware,
@@ -26,25 +63,149 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-model = genai.GenerativeModel("gemini-1.5-flash-latest")
+# CSV output compresses well; quality 4 keeps the CPU cost negligible next to the Gemini calls.
+# XLSX is already a zip archive, so the Excel export is left alone. Clients without Brotli get gzip.
+app.add_middleware(
+    BrotliMiddleware,
+    quality=4,
+    minimum_size=1024,
+    gzip_fallback=True,
+    excluded_handlers=[r"^/export-to-excel/"],
+)
+
+MODEL_NAME = "gemini-1.5-flash-latest"
+
+@lru_cache(maxsize=4)
+def load_model(name):
+    return genai.GenerativeModel(name)
+
+def get_model():
+    """FastAPI dependency returning the shared, already-warmed model client."""
+    return load_model(MODEL_NAME)
+
+# Build the default client at import time so the first request doesn't pay for it.
+get_model()
+
+# --- EXTRACTION CACHE ---
+
+CACHE_SWEEP_INTERVAL = 3600
+CACHE_TMP_MAX_AGE = 3600
+
+class ExtractionCache:
+    """Disk-backed cache of parsed Gemini results, keyed by upload content and prompt version."""
+
+    def __init__(self, directory, ttl=None):
+        self.directory = directory
+        self.ttl = ttl
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def make_key(content_hash, prompt_version, model_name=MODEL_NAME):
+        """Builds a cache key from the upload's sha256 hexdigest, the prompt version and the model."""
+        digest = hashlib.sha256(f"{content_hash}\x00{prompt_version}\x00{model_name}".encode())
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                entry = orjson.loads(f.read())
+        except (OSError, ValueError):
+            return None
+        if not isinstance(entry, dict) or entry.get("model") != MODEL_NAME or "result" not in entry:
+            return None
+        if self.ttl is not None and time.time() - entry.get("timestamp", 0) > self.ttl:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        return entry["result"]
+
+    def put(self, key, value):
+        now = datetime.now(timezone.utc)
+        entry = {
+            "created_at": now.isoformat(),
+            "timestamp": now.timestamp(),
+            "model": MODEL_NAME,
+            "result": value,
+        }
+        # Write to a temp file first so concurrent readers never see a partial entry. mkstemp gives each
+        # writer its own file, including concurrent puts of the same key from threads in one process.
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        except OSError:
+            return
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(orjson.dumps(entry))
+            os.replace(tmp_path, self._path(key))
+        except (OSError, TypeError):
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    def evict_expired(self):
+        """Deletes entries older than the TTL, judged by file mtime, plus leftover temp files."""
+        now = time.time()
+        try:
+            entries = os.scandir(self.directory)
+        except OSError:
+            return
+        with entries:
+            for entry in entries:
+                try:
+                    if entry.name.endswith(".json"):
+                        expired = self.ttl is not None and now - entry.stat().st_mtime > self.ttl
+                    else:
+                        # Stray temp files from interrupted writes.
+                        expired = entry.name.endswith(".tmp") and now - entry.stat().st_mtime > CACHE_TMP_MAX_AGE
+                    if expired:
+                        os.remove(entry.path)
+                except OSError:
+                    pass
+
+async def sweep_cache_periodically():
+    """Evicts expired cache entries at startup and then every CACHE_SWEEP_INTERVAL seconds."""
+    while True:
+        await asyncio.to_thread(extraction_cache.evict_expired)
+        await asyncio.sleep(CACHE_SWEEP_INTERVAL)
+
+_cache_ttl = os.environ.get("EXTRACTION_CACHE_TTL")
+extraction_cache = ExtractionCache(
+    os.environ.get("EXTRACTION_CACHE_DIR", ".extraction_cache"),
+    ttl=float(_cache_ttl) if _cache_ttl else 7 * 24 * 3600,
+)
 
 # --- PROMPTS ---
 
-def create_discovery_prompt():
-    """Creates a prompt to discover the column headers from the document."""
-    return """
+# Number of Expense Code/Amount column pairs in the output template.
+MAX_EXPENSE_COLUMNS = 10
+
+# Bump these whenever the corresponding prompt changes so stale cache entries are ignored.
+PROCESS_PROMPT_VERSION = "process-v4"
+EXPORT_PROMPT_VERSION = "export-v2"
+
+# Prompt to discover the column headers from the document.
+DISCOVERY_PROMPT = f"""
     Analyze the provided image of a ledger or bill.
     Your first task is to identify all the unique charge or expense column headers in the table.
     List only the names of these charge columns.
     Return the result as a clean, single-line, comma-separated string.
     Example: Property Tax,Water Charges,Sinking Fund,Maint. Charges
+    Return at most {MAX_EXPENSE_COLUMNS} headers. If more exist, combine the less significant ones under the header 'Other'.
     """
 
-def create_extraction_prompt(discovered_headers):
-    """Creates a dynamic prompt with robust instructions for handling messy data."""
-    return f"""
+# Static parts of the extraction prompt; only the discovered headers are filled in per request.
+_EXTRACTION_HEAD = """
     You are an expert data entry clerk. Analyze the provided image of a ledger.
-    Based on the following charge categories that were discovered from this document: {', '.join(discovered_headers)}
+    Based on the following charge categories that were discovered from this document: """
+
+_EXTRACTION_RULES = """
     Your task is to extract information for every single member listed and structure the data into a valid JSON array.
 
     RULES FOR EXTRACTION:
@@ -52,26 +213,33 @@ def create_extraction_prompt(discovered_headers):
     2. If a "Member Name" is not explicitly given for a row, set its value to null.
     3. For each discovered charge category, extract the corresponding monetary value for the member.
     4. If a member does not have a value for a specific charge (i.e., the cell is blank), you MUST represent it as null in the output.
-    5. The final output must be a clean, raw JSON array and nothing else.
+    5. If "Other" is one of the charge categories and the ledger has no column of that name, its value is the sum of the member's amounts in all the charge columns not listed above.
+    6. The final output must be a clean, raw JSON array and nothing else.
 
     The JSON schema you must follow is:
     [
-        {{
+        {
             "Wing": "string or null",
             "Unit No": "string or null",
             "Member Name": "string or null",
-            "Charges": {{
-                "{discovered_headers[0]}": "float or null",
-                "{discovered_headers[1]}": "float or null",
-                "...and so on for all discovered headers"
-            }}
-        }}
+            "Charges": {
+"""
+
+_EXTRACTION_TAIL = """                "...and so on for all discovered headers"
+            }
+        }
     ]
     """
 
-def create_direct_export_prompt():
-    """Creates a simpler prompt for direct-to-Excel export."""
-    return """
+def create_extraction_prompt(discovered_headers):
+    """Creates a dynamic prompt with robust instructions for handling messy data."""
+    # Only the first two headers are spelled out in the schema example, as before; slicing
+    # keeps a single discovered header from raising IndexError.
+    schema_lines = "".join(f'                "{header}": "float or null",\n' for header in discovered_headers[:2])
+    return "".join((_EXTRACTION_HEAD, ", ".join(discovered_headers), _EXTRACTION_RULES, schema_lines, _EXTRACTION_TAIL))
+
+# Simpler prompt for direct-to-Excel export.
+DIRECT_EXPORT_PROMPT = """
     You are an expert at table data extraction.
     Analyze the provided image and identify the main table.
     Extract all the data from the table exactly as it appears, row by row.
@@ -82,104 +250,345 @@ def create_direct_export_prompt():
     """
 
 # --- Reusable function to handle file upload and image conversion ---
-async def get_image_from_upload(file: UploadFile):
+# Ledger text stays legible well below pdf2image's default 200 DPI, and smaller images
+# mean less upload and fewer vision tokens per Gemini call.
+PDF_RENDER_DPI = 150
+# pdftocairo renders faster than pdftoppm; threads only help once more than one page is rendered.
+PDF_RENDER_THREADS = 2
+MAX_IMAGE_SIZE = (2000, 2000)
+JPEG_QUALITY = 85
+
+async def read_upload(file: UploadFile):
+    """Copies the upload into a spooled temp file in chunks, enforcing the size cap and hashing as it goes."""
     if not file.content_type in ["image/jpeg", "image/png", "application/pdf"]:
         raise HTTPException(status_code=400, detail="Unsupported file type.")
-    
-    file_bytes = await file.read()
 
-    if file.content_type == "application/pdf":
-        try:
-            images = convert_from_bytes(file_bytes, first_page=1, last_page=1)
-            if not images:
-                raise HTTPException(status_code=400, detail="Could not extract an image from the PDF.")
-            return images[0]
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"PDF processing failed: {e}")
-    else:
-        return Image.open(io.BytesIO(file_bytes))
+    spool = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_SIZE)
+    hasher = hashlib.sha256()
+    total = 0
+    while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+        total += len(chunk)
+        if total > MAX_UPLOAD_BYTES:
+            spool.close()
+            raise HTTPException(status_code=413, detail="File too large.")
+        hasher.update(chunk)
+        spool.write(chunk)
+    spool.seek(0)
+    return spool, hasher.hexdigest()
 
+def image_part(data, mime_type):
+    """Wraps encoded image bytes as an inline part that the SDK uploads without re-encoding."""
+    return {"mime_type": mime_type, "data": data}
 
-# --- ENDPOINT 1: PROCESS DOCUMENT INTO SPECIFIC TEMPLATE ---
-@app.post("/process-document/")
-async def process_document(file: UploadFile = File(...)):
-    image_to_process = await get_image_from_upload(file)
+# Formats Gemini accepts as-is; anything else is re-encoded.
+PASSTHROUGH_FORMATS = {"JPEG", "PNG"}
+
+def prepare_image(fp):
+    """Passes a JPEG/PNG upload through as-is, re-encoding it once as JPEG when it is another format or must be downscaled."""
+    # Image.open only parses the header, so checking the format and size doesn't decode the pixels.
+    # The detected format is used rather than the client's content type, which may not match the bytes.
+    image = Image.open(fp)
+    if image.format in PASSTHROUGH_FORMATS and image.width <= MAX_IMAGE_SIZE[0] and image.height <= MAX_IMAGE_SIZE[1]:
+        fp.seek(0)
+        return image_part(fp.read(), Image.MIME[image.format])
+    image.thumbnail(MAX_IMAGE_SIZE, Image.LANCZOS)
+    buffer = io.BytesIO()
+    image.convert("RGB").save(buffer, format="JPEG", quality=JPEG_QUALITY)
+    return image_part(buffer.getvalue(), "image/jpeg")
+
+def render_pdf_page(pdf_bytes):
+    """Renders the first PDF page to JPEG and returns poppler's encoded output, without decoding it in PIL."""
+    with tempfile.TemporaryDirectory() as output_folder:
+        paths = convert_from_bytes(
+            pdf_bytes, first_page=1, last_page=1, dpi=PDF_RENDER_DPI, fmt="jpeg",
+            jpegopt={"quality": JPEG_QUALITY}, output_folder=output_folder, paths_only=True,
+            use_pdftocairo=True, thread_count=PDF_RENDER_THREADS,
+        )
+        if not paths:
+            return None
+        with open(paths[0], "rb") as f:
+            return image_part(f.read(), "image/jpeg")
+
+async def get_image_from_upload(spool, content_type):
+    """Returns the image part to send to Gemini for an upload spooled by read_upload, closing the spool."""
+    with spool:
+        if content_type == "application/pdf":
+            try:
+                # pdf2image only accepts bytes or a path, so this is the one place the upload is materialized.
+                part = await asyncio.to_thread(render_pdf_page, spool.read())
+                if part is None:
+                    raise HTTPException(status_code=400, detail="Could not extract an image from the PDF.")
+                return part
+            except Exception as e:
+                raise HTTPException(status_code=500, detail=f"PDF processing failed: {e}")
+        else:
+            return await asyncio.to_thread(prepare_image, spool)
+
+
+# --- Helper to pull the JSON payload out of a model response ---
+_JSON_FENCE_RE = re.compile(r"```(?:json)?\s*(.*?)\s*```", re.DOTALL | re.IGNORECASE)
+_JSON_EXTRACT_RE = re.compile(r"(\[.*\]|\{.*\})", re.DOTALL)
 
+def extract_json(text):
+    """Returns the JSON inside a markdown code fence, or the outermost array/object in the text."""
+    match = _JSON_FENCE_RE.search(text) or _JSON_EXTRACT_RE.search(text)
+    return match.group(1) if match else text.strip()
+
+
+# --- Schema for the template extraction output ---
+_CURRENCY_PREFIX_RE = re.compile(r"(?:rs\.?|inr|₹)\s*", re.IGNORECASE)
+_AMOUNT_RE = re.compile(r"\d[\d,]*(?:\.\d+)?|\.\d+")
+_BLANK_AMOUNTS = {"", "-", "--", "–", "—", "na", "n/a", "nil", "null", "none"}
+
+def normalize_amount(value):
+    """Turns amounts the model writes as text into a plain number string.
+
+    >>> [normalize_amount(v) for v in ("Rs.500", "Rs.1,200", "(Rs.500)", "Rs. 1,200.00", "₹ 500", "INR 75.5")]
+    ['500', '1200', '-500', '1200.00', '500', '75.5']
+    >>> [normalize_amount(v) for v in ("-30.5", "(1,200.00)", "500/-", ".5", "-", "abc")]
+    ['-30.5', '-1200.00', '500', '.5', None, 'abc']
+    """
+    if not isinstance(value, str):
+        return value
+    text = value.strip()
+    if text.lower() in _BLANK_AMOUNTS:
+        return None
+    # Accounting style negatives: (1,200.00)
+    negative = text.startswith("(") and text.endswith(")")
+    if negative:
+        text = text[1:-1].strip()
+    if text.startswith("-"):
+        negative = True
+        text = text[1:].lstrip()
+    # Drop the currency token first, so the dot in "Rs." can't be read as a decimal point.
+    prefix = _CURRENCY_PREFIX_RE.match(text)
+    if prefix:
+        text = text[prefix.end():]
+    match = _AMOUNT_RE.match(text)
+    if not match:
+        # Leave it for float validation to reject, so the error is fed back to the model.
+        return value
+    number = match.group().replace(",", "")
+    return f"-{number}" if negative else number
+
+Amount = Annotated[Optional[float], BeforeValidator(normalize_amount)]
+# A null Charges object means no charges, the same as iter_template_rows treats it.
+ChargeMap = Annotated[Dict[str, Amount], BeforeValidator(lambda value: {} if value is None else value)]
+
+class Member(BaseModel):
+    # Unit numbers in particular often come back as JSON numbers.
+    model_config = ConfigDict(populate_by_name=True, coerce_numbers_to_str=True)
+
+    Wing: Optional[str] = None
+    Unit_No: Optional[str] = Field(default=None, alias="Unit No")
+    Member_Name: Optional[str] = Field(default=None, alias="Member Name")
+    Charges: ChargeMap = Field(default_factory=dict)
+
+_MEMBERS_ADAPTER = TypeAdapter(List[Member])
+
+# How many times a malformed or off-schema extraction is sent back to the model with the error.
+EXTRACTION_RETRIES = 2
+
+def parse_members(text):
+    """Parses and validates the extraction output, returning plain dicts keyed as in the prompt schema."""
+    members = _MEMBERS_ADAPTER.validate_python(orjson.loads(extract_json(text)))
+    return [member.model_dump(by_alias=True) for member in members]
+
+
+def check_table_rows(data):
+    """Ensures the direct export output is a list of row objects or a list of row arrays."""
+    if not isinstance(data, list):
+        raise ValueError(f"expected a JSON array of rows, got {type(data).__name__}")
+    if not (all(isinstance(row, dict) for row in data) or all(isinstance(row, list) for row in data)):
+        raise ValueError("expected every row to be a JSON object, or every row to be a JSON array")
+    return data
+
+
+# --- Gemini calls, separated from the endpoints so results can be cached ---
+# The SDK client is blocking, so calls run in a worker thread to keep the event loop free.
+async def run_process_extraction(model, image_to_process):
     try:
-        discovery_prompt = create_discovery_prompt()
-        response = model.generate_content([discovery_prompt, image_to_process])
+        response = await asyncio.to_thread(model.generate_content, [DISCOVERY_PROMPT, image_to_process])
         header_text = response.text.strip()
-        discovered_headers = [h.strip() for h in header_text.split(',') if h.strip()]
+        # The template only has room for MAX_EXPENSE_COLUMNS, so don't ask for values that would be dropped.
+        discovered_headers = [h.strip() for h in header_text.split(',') if h.strip()][:MAX_EXPENSE_COLUMNS]
         if not discovered_headers:
              raise HTTPException(status_code=400, detail="Could not identify any expense headers in the document.")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to discover headers from the document: {e}")
 
+    extraction_prompt = create_extraction_prompt(discovered_headers)
+    prompt = extraction_prompt
+    for attempt in range(EXTRACTION_RETRIES + 1):
+        try:
+            response = await asyncio.to_thread(model.generate_content, [prompt, image_to_process])
+            return discovered_headers, parse_members(response.text)
+        except (orjson.JSONDecodeError, ValidationError) as e:
+            # Feed the error back rather than failing, so the user doesn't have to re-upload.
+            if attempt == EXTRACTION_RETRIES:
+                raise HTTPException(status_code=500, detail=f"An error occurred during data extraction: {e}")
+            # Each call is stateless, so the rejected output has to be shown again for the model to fix it.
+            prompt = (
+                f"{extraction_prompt}\n    Your last output was:\n{response.text}\n"
+                f"    It had error: {e}. Return corrected JSON only.\n"
+            )
+            await asyncio.sleep(1 * (attempt + 1))
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"An error occurred during data extraction: {e}")
+
+async def run_direct_export(model, image_to_process):
     try:
-        extraction_prompt = create_extraction_prompt(discovered_headers)
-        response = model.generate_content([extraction_prompt, image_to_process])
-        json_text = response.text.strip().replace("```json", "").replace("```", "")
-        extracted_data = json.loads(json_text)
+        response = await asyncio.to_thread(model.generate_content, [DIRECT_EXPORT_PROMPT, image_to_process])
+        return check_table_rows(orjson.loads(extract_json(response.text)))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"An error occurred during data extraction: {e}")
 
-    all_rows = []
-    for member in extracted_data:
-        # **FIXED LINE IS HERE** - Added the missing '}' at the end of this dictionary definition
-        flat_row = {
-            "Bill Number": f"{member.get('Wing', '') or ''}-{member.get('Unit No', '') or ''}".strip('-'),
-            "Bill Date": None,
-            "Vendor Code": None,
-            "Due Date": None,
-            "Narration": member.get("Member Name"),
-            "CGST Tax Ledger Code": None, "CGST Amount": None,
-            "SGST Tax Ledger Code": None, "SGST Amount": None,
-            "IGST Tax Ledger Code": None, "IGST Amount": None,
-            "TDS Code": None, "TDS Amount": None
-        }
-        charges = member.get("Charges", {})
-        for i, header in enumerate(discovered_headers):
-            column_number = i + 1
-            if column_number > 10: break
-            amount = charges.get(header)
-            flat_row[f"Expense Code {column_number}"] = header
-            flat_row[f"Expense Amount {column_number}"] = amount
-        start_index = len(discovered_headers)
-        if start_index < 10:
-            for i in range(start_index, 10):
-                column_number = i + 1
-                flat_row[f"Expense Code {column_number}"] = None
-                flat_row[f"Expense Amount {column_number}"] = None
-        all_rows.append(flat_row)
-
-    if not all_rows: raise HTTPException(status_code=400, detail="No data could be processed.")
-    df = pd.DataFrame(all_rows)
-    csv_buffer = io.StringIO()
-    df.to_csv(csv_buffer, index=False)
-    
-    return StreamingResponse(iter([csv_buffer.getvalue()]), media_type="text/csv", headers={"Content-Disposition": "attachment; filename=converted_template.csv"})
+
+# --- OUTPUT WRITERS ---
+TEMPLATE_COLUMNS = [
+    "Bill Number", "Bill Date", "Vendor Code", "Due Date", "Narration",
+    "CGST Tax Ledger Code", "CGST Amount",
+    "SGST Tax Ledger Code", "SGST Amount",
+    "IGST Tax Ledger Code", "IGST Amount",
+    "TDS Code", "TDS Amount",
+] + [f"Expense {kind} {i}" for i in range(1, MAX_EXPENSE_COLUMNS + 1) for kind in ("Code", "Amount")]
+
+# Fixed slot offsets into a template row, resolved once rather than per request.
+_BILL_NUMBER_SLOT = TEMPLATE_COLUMNS.index("Bill Number")
+_NARRATION_SLOT = TEMPLATE_COLUMNS.index("Narration")
+# Expense Code/Amount columns alternate, so each kind sits at every other index.
+_FIRST_EXPENSE_CODE_SLOT = TEMPLATE_COLUMNS.index("Expense Code 1")
+_FIRST_EXPENSE_AMOUNT_SLOT = TEMPLATE_COLUMNS.index("Expense Amount 1")
+
+def iter_template_rows(discovered_headers, extracted_data):
+    """Yields one flat template row (a list in TEMPLATE_COLUMNS order) per member.
+
+    discovered_headers is expected to be capped at MAX_EXPENSE_COLUMNS already, as run_process_extraction does.
+    """
+    # Everything except the bill number, narration and amounts is identical for every member,
+    # so build it once and copy it per row instead of rebuilding a 33-key dict each time.
+    template = [None] * len(TEMPLATE_COLUMNS)
+    template[_FIRST_EXPENSE_CODE_SLOT:_FIRST_EXPENSE_CODE_SLOT + 2 * len(discovered_headers):2] = discovered_headers
+    amount_slice = slice(_FIRST_EXPENSE_AMOUNT_SLOT, _FIRST_EXPENSE_AMOUNT_SLOT + 2 * len(discovered_headers), 2)
+
+    # Gather the charges into one column per header up front, aligned by member index, so each
+    # row below takes its amounts in a single slice assignment.
+    n = len(extracted_data)
+    charge_cols = [[None] * n for _ in discovered_headers]
+    for i, member in enumerate(extracted_data):
+        charges = member.get("Charges") or {}
+        for header, column in zip(discovered_headers, charge_cols):
+            column[i] = charges.get(header)
+    amount_rows = zip(*charge_cols) if discovered_headers else itertools.repeat(())
+
+    for member, amounts in zip(extracted_data, amount_rows):
+        row = template[:]
+        row[_BILL_NUMBER_SLOT] = "-".join(filter(None, (member.get("Wing"), member.get("Unit No"))))
+        row[_NARRATION_SLOT] = member.get("Member Name")
+        row[amount_slice] = amounts
+        yield row
+
+def iter_csv(columns, rows, batch_size=256):
+    """Encodes the header plus list rows as CSV, yielding one chunk per batch of rows."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow(columns)
+    # Each yielded chunk becomes its own ASGI send, so emit batches rather than single lines.
+    rows = iter(rows)
+    for batch in iter(lambda: list(itertools.islice(rows, batch_size)), []):
+        writer.writerows(batch)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+def write_excel(output, records, sheet_name):
+    """Writes row dicts or row lists to an .xlsx file with xlsxwriter, flushing each row as it is written."""
+    if records and isinstance(records[0], dict):
+        # Column order follows first appearance across all rows, matching pd.DataFrame(records).
+        columns = list(dict.fromkeys(key for record in records for key in record))
+        rows = ([record.get(column) for column in columns] for record in records)
+    else:
+        # Positional rows get numbered headers, as pd.DataFrame gives them.
+        columns = list(range(max(map(len, records), default=0)))
+        rows = records
+    workbook = xlsxwriter.Workbook(output, {"constant_memory": True})
+    sheet = workbook.add_worksheet(sheet_name)
+    sheet.write_row(0, 0, columns)
+    for row_number, row in enumerate(rows, start=1):
+        sheet.write_row(row_number, 0, [_excel_cell(value) for value in row])
+    workbook.close()
+
+def iter_buffer(buffer, chunk_size=64 * 1024):
+    """Yields a binary buffer in fixed-size chunks rather than iterating it line by line."""
+    while chunk := buffer.read(chunk_size):
+        yield chunk
+
+def _excel_cell(value):
+    if isinstance(value, (dict, list)):
+        return orjson.dumps(value).decode()
+    return value
+
+
+# --- ENDPOINT 1: PROCESS DOCUMENT INTO SPECIFIC TEMPLATE ---
+@app.post("/process-document/")
+async def process_document(file: UploadFile = File(...), model: genai.GenerativeModel = Depends(get_model)):
+    spool, content_hash = await read_upload(file)
+
+    # Look the upload up by its full hash before rasterizing, so a cache hit skips the conversion too.
+    cache_key = ExtractionCache.make_key(content_hash, PROCESS_PROMPT_VERSION)
+    cached = await asyncio.to_thread(extraction_cache.get, cache_key)
+    if cached is not None:
+        spool.close()
+        discovered_headers, extracted_data = cached["headers"], cached["data"]
+    else:
+        image_to_process = await get_image_from_upload(spool, file.content_type)
+        discovered_headers, extracted_data = await run_process_extraction(model, image_to_process)
+        await asyncio.to_thread(extraction_cache.put, cache_key, {"headers": discovered_headers, "data": extracted_data})
+
+    if not extracted_data: raise HTTPException(status_code=400, detail="No data could be processed.")
+
+    rows = iter_template_rows(discovered_headers, extracted_data)
+    return StreamingResponse(iter_csv(TEMPLATE_COLUMNS, rows), media_type="text/csv", headers={"Content-Disposition": "attachment; filename=converted_template.csv"})
 
 
 # --- ENDPOINT 2: EXPORT DOCUMENT DIRECTLY TO EXCEL ---
 @app.post("/export-to-excel/")
-async def export_to_excel(file: UploadFile = File(...)):
-    image_to_process = await get_image_from_upload(file)
+async def export_to_excel(file: UploadFile = File(...), model: genai.GenerativeModel = Depends(get_model)):
+    spool, content_hash = await read_upload(file)
 
-    try:
-        direct_export_prompt = create_direct_export_prompt()
-        response = model.generate_content([direct_export_prompt, image_to_process])
-        json_text = response.text.strip().replace("```json", "").replace("```", "")
-        extracted_data = json.loads(json_text)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"An error occurred during data extraction: {e}")
+    cache_key = ExtractionCache.make_key(content_hash, EXPORT_PROMPT_VERSION)
+    extracted_data = await asyncio.to_thread(extraction_cache.get, cache_key)
+    if extracted_data is not None:
+        spool.close()
+    else:
+        image_to_process = await get_image_from_upload(spool, file.content_type)
+        extracted_data = await run_direct_export(model, image_to_process)
+        await asyncio.to_thread(extraction_cache.put, cache_key, extracted_data)
 
     if not extracted_data:
         raise HTTPException(status_code=400, detail="No data could be extracted for Excel export.")
     
-    df = pd.DataFrame(extracted_data)
-
     excel_buffer = io.BytesIO()
-    df.to_excel(excel_buffer, index=False, sheet_name="Extracted Data")
+    await asyncio.to_thread(write_excel, excel_buffer, extracted_data, "Extracted Data")
     excel_buffer.seek(0)
     
-    return StreamingResponse(excel_buffer, media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", headers={"Content-Disposition": "attachment; filename=exported_data.xlsx"})
\ No newline at end of file
+    return StreamingResponse(iter_buffer(excel_buffer), media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", headers={"Content-Disposition": "attachment; filename=exported_data.xlsx"})
+
+
+# --- Local / production entry point ---
+# Equivalent to: uvicorn main:app --loop uvloop --http httptools --workers $(nproc) --limit-concurrency 64 --backlog 2048
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(
+        "main:app",
+        host=os.environ.get("HOST", "0.0.0.0"),
+        port=int(os.environ.get("PORT", "8000")),
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.environ.get("WEB_CONCURRENCY", os.cpu_count() or 1)),
+        limit_concurrency=64,
+        backlog=2048,
+    )